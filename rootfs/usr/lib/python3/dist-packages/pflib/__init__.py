@@ -22,18 +22,46 @@
 # If not, see https://www.gnu.org/licenses/.
 
 import os
-import csv
+import re
+import json
+import hashlib
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from os.path import exists
-from random import choice
+from random import choice, uniform
 import tzlocal
 
 from pflib import discord
+from pflib import planeindex
 from .us_states import get_us_state_abbrev
 
 
 DEFAULT_PLANEFILE="/usr/share/planefence/persist/.internal/plane-alert-db.txt"
 
+# Column names of the plane-alert-db file, in order. Any columns after these are photo links.
+PLANEDB_FIELDS = ("icao", "tail_num", "owner", "type", "icao_type", "authority",
+                  "tag1", "tag2", "tag3", "category", "link")
+_PLANEDB_PADDING = [""] * len(PLANEDB_FIELDS)
+
+# A plane-db row; missing columns are "" and photos holds the row's photo links
+PlaneRecord = namedtuple("PlaneRecord", PLANEDB_FIELDS + ("photos",),
+                         defaults=("",) * len(PLANEDB_FIELDS) + ((),))
+# Returned for planes that aren't in the plane-db
+_EMPTY_RECORD = PlaneRecord()
+
+# KEY=value lines of planefence.config. Comments are skipped, as are lines with more than one "="
+_CONFIG_LINE = re.compile(r'^[ \t]*([^#=\s][^=\n]*?)[ \t]*=[ \t]*([^=\n]*?)[ \t\r]*$', re.M)
+
+# str.translate() table that deletes square brackets
+_STRIP_BRACKETS = str.maketrans("", "", "[]")
+
+_EMERGENCY_SQUAWKS = frozenset(('7700', '7600', '7500'))
+
+# Display units derived from the config, see load_units()
+UnitsConfig = namedtuple("UnitsConfig", ("alt_unit", "elevation", "dist_unit"))
+
 
 class InvalidConfigException(Exception):
     pass
@@ -48,14 +76,37 @@ def init_log(system):
     global log
 
     def systemlog(msg):
-        timestamp = datetime.now().strftime('%c')
-        print(f"[{system}][{timestamp}] {msg}")
+        print(f"[{system}][{_log_timestamp()}] {msg}")
     log = systemlog
 
 
+def _log_timestamp():
+    global _last_log_ts
+
+    # strftime('%c') only changes once a second, so format it at most once a second.
+    # (second, text) is swapped as one tuple so concurrent senders never see a mismatched pair.
+    sec = int(time.time())
+    cached = _last_log_ts
+    if cached[0] != sec:
+        cached = (sec, time.strftime('%c', time.localtime(sec)))
+        _last_log_ts = cached
+    return cached[1]
+
+
 # Global variables
 log = None
-planedb = {}
+_last_log_ts = (None, "")
+planefile = DEFAULT_PLANEFILE
+planedb_index = {}
+
+# One pooled HTTP session per process, so every Discord POST after the first reuses
+# the TCP/TLS connection instead of doing a fresh handshake. Created by _session().
+_SESSION = None
+_RATE_LIMIT_ATTEMPTS = 5
+# Discord rate limits each webhook separately: sha1 of url -> (requests remaining, time.time() of reset).
+# Every alert runs in a new process, so the buckets are carried over in the private cache dir.
+_BUCKETS = {}
+_BUCKETS_FILE = "discord-buckets.json"
 
 
 def load_config():
@@ -73,13 +124,7 @@ def load_config():
     config_path = f"{pfdir}/planefence.config"
     if exists(config_path):
         with open(config_path) as cfgfile:
-            lines = cfgfile.readlines()
-            for _, line in enumerate(lines):
-                if line.strip().startswith("#"):
-                    continue
-                split = line.split("=")
-                if len(split) == 2:
-                    config[split[0].strip()] = split[1].strip()
+            config.update(_CONFIG_LINE.findall(cfgfile.read()))
 
     if os.getenv("DEBUG", "") == "ON":
         from pprint import pprint; pprint(config)
@@ -91,67 +136,37 @@ def load_config():
     except:
         raise InvalidConfigException
 
+    config['UNITS'] = load_units(config)
+
     load_planefile(config)
 
     return config
 
 
 def load_planefile(config):
-    global planedb
-
-    planedb = {}
-    with open(config['PLANEFILE']) as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            #  $ICAO,$Registration,$Operator,$Type,$ICAO Type,#CMPG,$Tag 1,$#Tag 2,$#Tag 3,Category,$#Link,#Image Link,#Image Link 2,#Image Link 3
-            # Example line:
-            #  A51316,N426NA,NASA,Lockheed P-3B Orion,P3,Gov,Sce To Aux,Airborne Science,Wallops Flight Facility,Distinctive,https://www.nasa.gov
-            # Skip header and invalid/empty lines
-            if row[0].startswith("#") or not row:
-                continue
-
-            plane = {
-                "icao": row[0],
-                "tail_num": row[1],
-                "owner": row[2],
-                "type": row[3],
-                "icao_type": row[4] if len(row) > 4 else "",
-                "authority": row[5] if len(row) > 5 else "",
-                "tag1": row[6] if len(row) > 6 else "",
-                "tag2": row[7] if len(row) > 7 else "",
-                "tag3": row[8] if len(row) > 8 else "",
-                "category": row[9] if len(row) > 9 else "" ,
-                "link": row[10] if len(row) > 10 else "",
-            }
-            if len(row) > 11:
-                plane['photos'] = [
-                    link for link in
-                    [
-                        _try_get_photo(row, 11),
-                        _try_get_photo(row, 12),
-                        _try_get_photo(row, 13)
-                    ]
-                    if link != ""
-                ]
-
-            planedb[plane["icao"]] = plane
-
-    log(f"Loaded {len(planedb)} entries into plane-db")
-
-def _try_get_photo(row, index):
-    try:
-        return row[index]
-    except:
-        return ""
+    global planefile, planedb_index
 
-def get_plane_info(icao):
-    return planedb.get(icao, {})
+    planefile = config['PLANEFILE']
+    planedb_index = planeindex.load_index(planefile)
 
-def altitude_str(config, alt):
-    alt_actual = alt
-    alt_type = "MSL"
-    alt_unit = "ft"
+    log(f"Indexed {len(planedb_index)} entries in plane-db")
 
+def get_plane_info(icao):
+    offset = planedb_index.get(icao)
+    if offset is None:
+        return _EMPTY_RECORD
+
+    #  $ICAO,$Registration,$Operator,$Type,$ICAO Type,#CMPG,$Tag 1,$#Tag 2,$#Tag 3,Category,$#Link,#Image Link,#Image Link 2,#Image Link 3
+    # Example line:
+    #  A51316,N426NA,NASA,Lockheed P-3B Orion,P3,Gov,Sce To Aux,Airborne Science,Wallops Flight Facility,Distinctive,https://www.nasa.gov
+    row = planeindex.read_row(planefile, offset)
+    # Padding makes missing optional columns ""
+    return PlaneRecord(*(row + _PLANEDB_PADDING)[:len(PLANEDB_FIELDS)],
+                       photos=tuple(link for link in row[11:14] if link != ""))
+
+def load_units(config):
+    # Units never change during a run, so work them out once from the config
+    alt_unit = "ft"
     if config.get("PF_ALTUNIT", "") == "meter":
         alt_unit = "m"
 
@@ -159,36 +174,42 @@ def altitude_str(config, alt):
     if config.get("PF_ELEVATION", "").isdigit():
         elevation = int(config["PF_ELEVATION"])
 
-    if elevation > 0:
-        alt_actual = alt - elevation
-        alt_type = "AGL"
+    cdu = config.get("PF_DISTUNIT", "")
+    dist_unit = "mi"
+    if cdu == "nauticalmile":
+        dist_unit = "nm"
+    elif cdu == "kilometer":
+        dist_unit = "km"
+    elif cdu == "meter":
+        dist_unit = "m"
 
-    altstr = '{:,}'.format(alt_actual)
-    return f"{altstr}{alt_unit} {alt_type}"
+    return UnitsConfig(alt_unit, elevation, dist_unit)
 
-def distance_unit(config):
-    cdu = config.get("PF_DISTUNIT", "")
+def altitude_str(units, alt):
+    alt_actual = alt
+    alt_type = "MSL"
 
-    if cdu == "nauticalmile":
-        return "nm"
-    if cdu == "kilometer":
-        return "km"
-    if cdu == "meter":
-        return "m"
-    return "mi"
+    if units.elevation > 0:
+        alt_actual = alt - units.elevation
+        alt_type = "AGL"
+
+    return f"{alt_actual:,}{units.alt_unit} {alt_type}"
+
+def distance_unit(units):
+    return units.dist_unit
 
 def get_timezone_str():
     return datetime.now(tzlocal.get_localzone()).strftime('%Z')
 
 def flightaware_link(icao, tail_num):
-    icao = icao.strip().replace("[", "").replace("]", "")
-    tail_num = tail_num.strip().replace("[", "").replace("]", "")
+    icao = icao.strip().translate(_STRIP_BRACKETS)
+    tail_num = tail_num.strip().translate(_STRIP_BRACKETS)
     return f"https://flightaware.com/live/modes/{icao}/ident/{tail_num}/redirect"
 
-def is_emergency(squawk):
-    return squawk in ('7700', '7600', '7500')
+# is_emergency(squawk): a bound set lookup, so the check costs no Python function call
+is_emergency = _EMERGENCY_SQUAWKS.__contains__
 
-def attach_media(config, subsystem, plane, webhook, embed):
+def attach_media(config, subsystem, plane, webhook, embed, with_screenshot=True):
     media_mode = config.get('DISCORD_MEDIA', "")
     testmsg(f"DISCORD_MEDIA: {config['DISCORD_MEDIA']}")
 
@@ -199,15 +220,20 @@ def attach_media(config, subsystem, plane, webhook, embed):
     image_url = ""
     thumb_url = ""
 
+    def screenshot_url():
+        # The screenshot file belongs to a single plane; callers sending several alerts
+        # in one message turn it off and keep only the per-plane photos
+        return get_screenshot_url(webhook, subsystem) if with_screenshot else ""
+
     if media_mode == "photo" and subsystem == "PA":
         image_url = get_photo_url(plane)
     elif media_mode == "screenshot":
-        image_url = get_screenshot_url(webhook, subsystem)
+        image_url = screenshot_url()
     elif media_mode == "photo+screenshot":
         image_url = get_photo_url(plane)
-        thumb_url = get_screenshot_url(webhook, subsystem)
+        thumb_url = screenshot_url()
     elif media_mode == "screenshot+photo":
-        image_url = get_screenshot_url(webhook, subsystem)
+        image_url = screenshot_url()
         thumb_url = get_photo_url(plane)
     else:
         log(f"[error] Unknown DISCORD_MEDIA mode: {media_mode}")
@@ -227,8 +253,12 @@ def attach_media(config, subsystem, plane, webhook, embed):
         embed.set_thumbnail(url=thumb_url)
 
 def get_photo_url(plane):
+    # Only Plane-Alert has a plane-db record, Planefence passes None
+    if plane is None:
+        return ""
+
     try:
-        photos = plane.get('photos', [])
+        photos = plane.photos
         if len(photos) > 0:
             testmsg(f"Plane Photos: {','.join(photos)}")
             url = choice(photos)
@@ -237,7 +267,7 @@ def get_photo_url(plane):
             testmsg(f"photo attachment: {url}")
             return url
         else:
-            testmsg(f"No plane photos for {plane['icao']}")
+            testmsg(f"No plane photos for {plane.icao}")
     except Exception as e:
         log("[error] unable to attach plane photo: " + e)
     return ""
@@ -254,11 +284,133 @@ def get_screenshot_url(webhook, subsystem):
         log("[error] Snapshot file doesn't exist during Discord run")
     return ""
 
+def _session():
+    global _SESSION
+
+    if _SESSION is None:
+        # requests is only imported once there is something to send
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Webhook POSTs aren't idempotent: a re-post after a 5xx or a lost reply can duplicate
+        # the alert. So urllib3 only retries connections that were never established; 5xx
+        # replies and read errors are not retried, and 429s are left to _post_with_backoff.
+        _SESSION = requests.Session()
+        _SESSION.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5)))
+    return _SESSION
+
 def send(webhook, config):
+    urls = webhook.url if isinstance(webhook.url, list) else [webhook.url]
     try:
-        webhook.execute()
+        payload = webhook.json
+        embeds = payload.get("embeds", [])
+        # Split the embeds over as few messages as Discord allows; attachments go with the first
+        batches = discord.batch_embeds(embeds) or [[]]
+
+        def post_batches(url):
+            # Keep message order within a channel; different webhooks don't depend on each other
+            for i, batch in enumerate(batches):
+                _post_with_backoff(url, {**payload, "embeds": batch}, webhook.files if i == 0 else None)
+
+        urls = [url.strip() for url in urls if url.strip() != ""]
+        # Create the session before any worker threads need it
+        _session()
+        _load_buckets()
+        try:
+            if len(urls) == 1:
+                post_batches(urls[0])
+            elif len(urls) > 1:
+                # Each webhook has its own rate limit bucket, so they can all be posted to at once
+                with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+                    # list() re-raises the first exception from any of the workers
+                    list(pool.map(post_batches, urls))
+        finally:
+            _save_buckets()
     except Exception as e:
         log("[error] Exception during send, printing config...")
         from pprint import pprint
         pprint(config)
         raise e
+
+def _post_with_backoff(url, payload, files=None):
+    # Same request discord_webhook's execute() makes, but over the shared session
+    for attempt in range(_RATE_LIMIT_ATTEMPTS):
+        _wait_for_bucket(url)
+        if files:
+            multipart = dict(files)
+            multipart["payload_json"] = (None, json.dumps(payload))
+            response = _session().post(url, files=multipart, timeout=10)
+        else:
+            response = _session().post(url, json=payload, timeout=10)
+        _update_bucket(url, response)
+
+        if response.status_code != 429 or attempt == _RATE_LIMIT_ATTEMPTS - 1:
+            break
+
+        # Rate limited: wait as long as Discord asks, plus some jitter so parallel
+        # senders don't all retry at the same moment
+        try:
+            delay = float(response.headers.get("Retry-After", 2 ** attempt))
+        except ValueError:
+            delay = 2 ** attempt
+        delay += uniform(0, 0.5)
+        log(f"[warning] Discord rate limit hit, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    if not response.ok:
+        log(f"[error] Discord webhook returned {response.status_code}: {response.text}")
+    return response
+
+def _bucket_key(url):
+    # The webhook URL contains its token, so the buckets are keyed by a hash of it
+    return hashlib.sha1(url.encode()).hexdigest()
+
+def _load_buckets():
+    private_dir = planeindex.cache_dir()
+    if private_dir is None:
+        return
+    buckets_path = f"{private_dir}/{_BUCKETS_FILE}"
+    try:
+        if not planeindex.is_private(buckets_path):
+            return
+        with open(buckets_path) as f:
+            saved = json.load(f)
+        now = time.time()
+        for key, (remaining, reset_at) in saved.items():
+            # Webhook buckets reset within seconds; anything far off is from a clock change
+            if now < reset_at < now + 60:
+                _BUCKETS.setdefault(key, (int(remaining), float(reset_at)))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        log(f"[warning] Ignoring unreadable Discord rate limit state {buckets_path}: {e}")
+
+def _save_buckets():
+    private_dir = planeindex.cache_dir()
+    if private_dir is None:
+        return
+    # Buckets that have already reset carry no information for the next run
+    now = time.time()
+    live = {key: bucket for key, bucket in _BUCKETS.items() if bucket[1] > now}
+    planeindex.write_private(f"{private_dir}/{_BUCKETS_FILE}", json.dumps(live).encode())
+
+def _wait_for_bucket(url):
+    # Hold off until the webhook's bucket resets rather than running into a 429
+    remaining, reset_at = _BUCKETS.get(_bucket_key(url), (1, 0.0))
+    if remaining > 0:
+        return
+    delay = reset_at - time.time()
+    if delay > 0:
+        time.sleep(delay + uniform(0, 0.1))
+
+def _update_bucket(url, response):
+    try:
+        remaining = int(response.headers["X-RateLimit-Remaining"])
+        reset_after = float(response.headers["X-RateLimit-Reset-After"])
+    except (KeyError, ValueError):
+        return
+    _BUCKETS[_bucket_key(url)] = (remaining, time.time() + reset_after)
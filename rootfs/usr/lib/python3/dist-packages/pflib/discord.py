@@ -1,7 +1,21 @@
-import discord_webhook as dw
+# Discord accepts at most this many embeds in a single webhook message,
+# with at most MAX_EMBED_CHARS characters of text across all of them
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+
+def new_webhook(urls):
+    # discord_webhook is imported on first use to keep it out of pflib's import time
+    import discord_webhook as dw
+    return dw.DiscordWebhook(url=urls)
 
 def build(urls, title, description, color=None):
-    webhook = dw.DiscordWebhook(url=urls)
+    webhook = new_webhook(urls)
+    embed = add(webhook, title, description, color=color)
+
+    return webhook, embed
+
+def add(webhook, title, description, color=None):
+    import discord_webhook as dw
 
     if color is None:
         color = 0x007bff  # Blue
@@ -10,9 +24,35 @@ def build(urls, title, description, color=None):
 
     webhook.add_embed(embed)
 
-    return webhook, embed
+    return embed
 
 def field(embed, name, value, inline=None):
     if inline is None:
         inline = True
     embed.add_embed_field(name=name, value=value, inline=inline)
+
+def embed_length(embed):
+    # The text Discord counts towards MAX_EMBED_CHARS for one embed dict
+    length = len(embed.get("title") or "") + len(embed.get("description") or "")
+    length += len((embed.get("footer") or {}).get("text") or "")
+    length += len((embed.get("author") or {}).get("name") or "")
+    for fld in embed.get("fields") or []:
+        length += len(fld.get("name") or "") + len(fld.get("value") or "")
+    return length
+
+def batch_embeds(embeds):
+    # Group embed dicts into messages that stay within both of Discord's limits
+    batches = []
+    batch = []
+    batch_chars = 0
+    for embed in embeds:
+        chars = embed_length(embed)
+        if batch and (len(batch) == MAX_EMBEDS or batch_chars + chars > MAX_EMBED_CHARS):
+            batches.append(batch)
+            batch = []
+            batch_chars = 0
+        batch.append(embed)
+        batch_chars += chars
+    if batch:
+        batches.append(batch)
+    return batches
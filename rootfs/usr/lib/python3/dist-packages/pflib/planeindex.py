@@ -0,0 +1,107 @@
+import csv
+import hashlib
+import mmap
+import os
+import pickle
+
+
+def build_index(path):
+    # The db is a concatenation of several alert lists and is not sorted by ICAO,
+    # so every row gets an entry. Later rows win, same as the old dict load.
+    index = {}
+    with open(path, "rb") as dbfile:
+        if os.fstat(dbfile.fileno()).st_size == 0:
+            return index
+        # Map the file and only copy out the ICAO column, the rest of each row is never touched
+        with mmap.mmap(dbfile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            offset = 0
+            while offset < size:
+                eol = mm.find(b"\n", offset)
+                if eol == -1:
+                    eol = size
+                if mm[offset:offset + 1] != b"#":
+                    comma = mm.find(b",", offset, eol)
+                    icao = mm[offset:eol if comma == -1 else comma].rstrip(b"\r")
+                    if icao.strip() != b"":
+                        index[icao.decode("utf-8", "replace")] = offset
+                offset = eol + 1
+    return index
+
+
+def is_private(path):
+    # Only trust cache files and dirs we own that nobody else can write to
+    stat = os.lstat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def cache_dir():
+    # The cache root is usually the world-writable /tmp, so keep the pickles in a
+    # private per-user subdirectory. Returns None if that directory can't be trusted.
+    cache_root = os.getenv("XDG_CACHE_HOME", "/tmp")
+    private_dir = f"{cache_root}/pflib-{os.getuid()}"
+    try:
+        os.makedirs(private_dir, mode=0o700, exist_ok=True)
+        if os.path.isdir(private_dir) and not os.path.islink(private_dir) and is_private(private_dir):
+            return private_dir
+    except OSError:
+        pass
+    return None
+
+
+def cache_path(path, private_dir):
+    # One cache file per db path; the db's mtime and size are stored inside it, so
+    # a rewritten db replaces its cache entry instead of leaving old ones behind
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return f"{private_dir}/planedb-{digest}.pkl"
+
+
+def write_private(path, data):
+    # Write under a temporary name first, so concurrent alerts never read a half-written file.
+    # O_EXCL with mode 0600 makes the file private whatever the umask is.
+    tmp_path = f"{path}.{os.getpid()}"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Unwritable or full cache dir; don't leave the partial file behind
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def load_index(path):
+    private_dir = cache_dir()
+    if private_dir is None:
+        # No safe place to cache; unpickling from an untrusted location could run foreign code
+        return build_index(path)
+
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    index_path = cache_path(path, private_dir)
+    try:
+        if is_private(index_path):
+            with open(index_path, "rb") as f:
+                cached_stamp, index = pickle.load(f)
+            if cached_stamp == stamp:
+                return index
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError) as e:
+        print(f"[pflib] Ignoring unreadable plane-db index cache {index_path}: {e}")
+
+    index = build_index(path)
+    write_private(index_path, pickle.dumps((stamp, index), protocol=pickle.HIGHEST_PROTOCOL))
+    return index
+
+
+def read_row(path, offset):
+    with open(path, "rb") as dbfile:
+        dbfile.seek(offset)
+        line = dbfile.readline().decode("utf-8", "replace")
+    return next(csv.reader([line]))
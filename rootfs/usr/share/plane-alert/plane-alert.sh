@@ -290,6 +290,17 @@ if [[ "$(cat /tmp/pa-diff.csv | wc -l)" != "0" ]]
 then
 	# Loop through the new planes and notify them. Initialize $ERRORCOUNT to capture the number of Tweet failures:
 	ERRORCOUNT=0
+
+	# Discord alerts are collected and sent in one go, unless DISCORD_MEDIA needs each plane's own screenshot
+	DISCORD_ON="false"
+	DISCORD_BATCHING="false"
+	DISCORD_BATCH=()
+	if [[ "${PA_DISCORD,,}" != "false" ]] && [[ "x$PA_DISCORD_WEBHOOKS" != "x" ]] && [[ "x$DISCORD_FEEDER_NAME" != "x" ]]
+	then
+		DISCORD_ON="true"
+		python3 $PLANEALERTDIR/send-discord-alert.py --can-batch && DISCORD_BATCHING="true" || true
+	fi
+
 	while IFS= read -r line
 	do
 		XX=$(echo -n $line | tr -d '[:cntrl:]')
@@ -313,7 +324,10 @@ then
 		fi
 
 		# Send Discord alerts if that's enabled
-		if [[ "${PA_DISCORD,,}" != "false" ]] && [[ "x$PA_DISCORD_WEBHOOKS" != "x" ]] && [[ "x$DISCORD_FEEDER_NAME" != "x" ]]
+		if [[ "$DISCORD_ON" == "true" ]] && [[ "$DISCORD_BATCHING" == "true" ]]
+		then
+			DISCORD_BATCH+=("$line")
+		elif [[ "$DISCORD_ON" == "true" ]]
 		then
 			[[ "$LOGLEVEL" != "ERROR" ]] && echo "planefence/plane-alert][$(date)] PlaneAlert sending Discord notification" || true
 			python3 $PLANEALERTDIR/send-discord-alert.py "$line"
@@ -474,6 +488,12 @@ then
 			fi
 		fi
 	done < /tmp/pa-diff.csv
+
+	if (( ${#DISCORD_BATCH[@]} > 0 ))
+	then
+		[[ "$LOGLEVEL" != "ERROR" ]] && echo "planefence/plane-alert][$(date)] PlaneAlert sending ${#DISCORD_BATCH[@]} Discord notification(s)" || true
+		python3 $PLANEALERTDIR/send-discord-alert.py "${DISCORD_BATCH[@]}"
+	fi
 fi
 
 [[ "$BASETIME" != "" ]] && echo "10e. $(bc -l <<< "$(date +%s.%2N) - $BASETIME")s -- plane-alert.sh: finished Tweet run, start building webpage" || true
@@ -2,7 +2,13 @@
 
 # Send Discord Alert is a utility for PLANE-ALERT
 #
-# Usage: ./send-discord-alert.py <inputfile>
+# Usage: ./send-discord-alert.py <csvline> [<csvline> ...]
+#        ./send-discord-alert.py --can-batch
+#
+# Several records are batched into shared Discord messages without the screenshot, since
+# that only belongs to one plane. plane-alert.sh asks --can-batch (exit status 0 = yes)
+# whether DISCORD_MEDIA needs no screenshot; if so it passes all new planes in one call,
+# otherwise it calls this once per plane right after fetching that plane's screenshot.
 #
 # Copyright 2022 Ramon F. Kolb - licensed under the terms and conditions
 # of GPLv3. The terms and conditions of this license are included with the Github
@@ -34,6 +40,15 @@ import pflib as pf
 from geopy.geocoders import Nominatim
 geolocator = Nominatim(user_agent="plane-alert")
 
+# Plane-db columns added to the alert when set: (column, field name, value template)
+DBINFO_FIELDS = (
+    ("category", "Category", "{}"),
+    ("tag1", "Tag", "{}"),
+    ("tag2", "Tag", "{}"),
+    ("tag3", "Tag", "{}"),
+    ("link", "Link", "[Learn More]({})"),
+)
+
 def get_readable_location(plane):
     loc = geolocator.reverse("{}, {}".format(plane['lat'], plane['long']), exactly_one=True, language='en')
     if loc is None:
@@ -61,7 +76,25 @@ def get_readable_location(plane):
     else:
         return f"{place}, {country}"
 
-def process_alert(config, plane):
+def can_batch(config):
+    # Only these media modes work without the per-plane screenshot
+    return config.get("DISCORD_MEDIA", "") in ("", "photo")
+
+
+def process_alerts(config, alerts):
+    # All alerts share one webhook, so they go out in as few messages as Discord's limits allow
+    webhook = pf.discord.new_webhook(config["PA_DISCORD_WEBHOOKS"])
+
+    # The screenshot on disk belongs to a single plane, only attach it for a single alert
+    with_screenshot = len(alerts) == 1
+    for plane in alerts:
+        process_alert(config, webhook, plane, with_screenshot)
+
+    # Send the message
+    pf.send(webhook, config)
+
+
+def process_alert(config, webhook, plane, with_screenshot):
     pf.log(f"Building Discord alert for {plane['icao']}")
 
     dbinfo = pf.get_plane_info(plane['icao'])
@@ -86,8 +119,8 @@ def process_alert(config, plane):
     else:
         description += f"\nSeen near [**{location}**]({plane['adsbx_url']})"
 
-    webhook, embed = pf.discord.build(config["PA_DISCORD_WEBHOOKS"], title, description, color=color)
-    pf.attach_media(config, "PA", dbinfo, webhook, embed)
+    embed = pf.discord.add(webhook, title, description, color=color)
+    pf.attach_media(config, "PA", dbinfo, webhook, embed, with_screenshot=with_screenshot)
 
     if config.get("DISCORD_FEEDER_NAME", "") != "":
         pf.discord.field(embed, "Feeder", config["DISCORD_FEEDER_NAME"])
@@ -102,23 +135,10 @@ def process_alert(config, plane):
     if plane.get('time', "") != "":
         pf.discord.field(embed, "First Seen", f"{plane['time']} {pf.get_timezone_str()}")
 
-    if dbinfo.get('category', "") != "":
-        pf.discord.field(embed, "Category", dbinfo['category'])
-
-    if dbinfo.get('tag1', "") != "":
-        pf.discord.field(embed, "Tag", dbinfo['tag1'])
-
-    if dbinfo.get('tag2', "") != "":
-        pf.discord.field(embed, "Tag", dbinfo['tag2'])
-
-    if dbinfo.get('tag3', "") != "":
-        pf.discord.field(embed, "Tag", dbinfo['tag3'])
-
-    if dbinfo.get('link', "") != "":
-        pf.discord.field(embed, "Link", f"[Learn More]({dbinfo['link']})")
-
-    # Send the message
-    pf.send(webhook, config)
+    for key, name, template in DBINFO_FIELDS:
+        value = getattr(dbinfo, key)
+        if value:
+            pf.discord.field(embed, name, template.format(value))
 
 
 def main():
@@ -127,31 +147,38 @@ def main():
     # Load configuration
     config = pf.load_config()
 
-    if len(sys.argv) != 2:
-        print("No input record passed\n\tUsage: ./send-discord-alert.py <csvline>")
+    if len(sys.argv) < 2:
+        print("No input record passed\n\tUsage: ./send-discord-alert.py <csvline> [<csvline> ...]"
+              "\n\t       ./send-discord-alert.py --can-batch"
+              "\n\tSeveral records are batched into shared messages without the screenshot")
         sys.exit(1)
 
-    # CSV format is:
-    #      ICAO,TailNr,Owner,PlaneDescription,date,time,lat,lon,callsign,adsbx_url,squawk
-    row = sys.argv[1].split(',')
-    alert = {
-        "icao": row[0].strip(),
-        "tail_num": row[1].strip(),
-        "owner": row[2].strip(),
-        "plane_desc": row[3],
-        "date": row[4],
-        "time": row[5],
-        "lat": row[6],
-        "long": row[7],
-        "callsign": row[8].strip(),
-        "adsbx_url": row[9],
-        "squawk": row[10] if len(row) > 10 else "",
-    }
-
-    # Process file and send alerts
-    process_alert(config, alert)
-
-    pf.log(f"Done sending Discord alert for {alert['icao']}")
+    if sys.argv[1:] == ["--can-batch"]:
+        sys.exit(0 if can_batch(config) else 1)
+
+    alerts = []
+    for record in sys.argv[1:]:
+        # CSV format is:
+        #      ICAO,TailNr,Owner,PlaneDescription,date,time,lat,lon,callsign,adsbx_url,squawk
+        row = record.split(',')
+        alerts.append({
+            "icao": row[0].strip(),
+            "tail_num": row[1].strip(),
+            "owner": row[2].strip(),
+            "plane_desc": row[3],
+            "date": row[4],
+            "time": row[5],
+            "lat": row[6],
+            "long": row[7],
+            "callsign": row[8].strip(),
+            "adsbx_url": row[9],
+            "squawk": row[10] if len(row) > 10 else "",
+        })
+
+    # Process records and send alerts
+    process_alerts(config, alerts)
+
+    pf.log(f"Done sending Discord alert for {', '.join(alert['icao'] for alert in alerts)}")
 
 
 if __name__ == "__main__":
@@ -68,10 +68,11 @@ def process_alert(config, plane):
 
     webhook, embed = pf.discord.build(
         config["PF_DISCORD_WEBHOOKS"],
-        f"{name} is overhead at {pf.altitude_str(config, plane['alt'])}",
+        f"{name} is overhead at {pf.altitude_str(config['UNITS'], plane['alt'])}",
         f"[Track on ADS-B Exchange]({plane['adsbx_url']})")
 
-    pf.attach_media(config, "PF", plane, webhook, embed)
+    # Planefence alerts have no plane-db record, so photo modes fall back to the screenshot
+    pf.attach_media(config, "PF", None, webhook, embed)
 
     if config.get("DISCORD_FEEDER_NAME", "") != "":
         pf.discord.field(embed, "Feeder", config["DISCORD_FEEDER_NAME"])
@@ -79,7 +80,7 @@ def process_alert(config, plane):
     # Attach data fields
     pf.discord.field(embed, "ICAO", plane['icao'])
     pf.discord.field(embed, "Tail Number", f"[{plane['tail_num']}]({fa_link})")
-    pf.discord.field(embed, "Distance", f"{plane['min_dist']}{pf.distance_unit(config)}")
+    pf.discord.field(embed, "Distance", f"{plane['min_dist']}{pf.distance_unit(config['UNITS'])}")
 
     time_seen = plane['first_seen'].split(" ")[1]
     pf.discord.field(embed, "First Seen", f"{time_seen} {pf.get_timezone_str()}")